@@ -1,4 +1,27 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
+from setuptools.command.build_ext import build_ext
+
+class OptionalBuildExt(build_ext):
+    '''
+    Builds the C kernels if possible. If there is no working compiler, the package falls back to Numba or NumPy.
+    '''
+    def build_extensions(self):
+        if self.compiler.compiler_type == 'unix':
+            for ext in self.extensions:
+                ext.extra_compile_args += ['-O3', '-fopenmp-simd', '-fno-math-errno']
+        super().build_extensions()
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            print(f'Warning: unable to build the C extension, falling back to the Python kernels ({e}).')
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except Exception as e:
+            print(f'Warning: unable to build {ext.name}, falling back to the Python kernels ({e}).')
 
 setup(
     name='pypeakify',
@@ -12,10 +35,16 @@ setup(
         'numpy',
         'scipy',
         'matplotlib',
-        'tabulate',
         'requests',
         'jcamp'
     ],
+    extras_require={
+        'numba': ['numba'],
+    },
+    ext_modules=[
+        Extension('pypeakify._peakkernel', ['src/pypeakify/_peakkernel.c']),
+    ],
+    cmdclass={'build_ext': OptionalBuildExt},
     package_dir={'': 'src'},
     classifiers=[
         'Programming Language :: Python :: 3',
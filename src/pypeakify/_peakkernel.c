@@ -0,0 +1,186 @@
+/*
+ * Fused kernels for evaluating a sum of Gaussian and Lorentzian peaks, and its
+ * Jacobian, in a single pass over x.
+ *
+ * Arrays are passed through the buffer protocol and must be C-contiguous
+ * float64 (x, widths, amplitudes, positions, out, jac) or one byte per peak
+ * (is_gaussian). The Python side in `pypeakify.peak` takes care of this.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <math.h>
+#include <stdint.h>
+#include <string.h>
+
+static void
+peak_sum(const double *x, size_t M, const double *w, const double *a,
+         const double *p, const uint8_t *is_gauss, size_t N, double *out)
+{
+    memset(out, 0, M * sizeof(double));
+    for (size_t k = 0; k < N; k++) {
+        const double inv_w = 1.0 / w[k], ak = a[k], pk = p[k];
+        if (is_gauss[k]) {
+            #pragma omp simd
+            for (size_t m = 0; m < M; m++) {
+                const double u = (x[m] - pk) * inv_w;
+                out[m] += ak * exp(-0.5 * u * u);
+            }
+        }
+        else {
+            #pragma omp simd
+            for (size_t m = 0; m < M; m++) {
+                const double u = (x[m] - pk) * inv_w;
+                out[m] += ak / (1.0 + u * u);
+            }
+        }
+    }
+}
+
+/* jac is (M, 3N) row-major, with columns (width, amplitude, position) per peak */
+static void
+peak_sum_and_jac(const double *x, size_t M, const double *w, const double *a,
+                 const double *p, const uint8_t *is_gauss, size_t N,
+                 double *out, double *jac)
+{
+    const size_t stride = 3 * N;
+    memset(out, 0, M * sizeof(double));
+    for (size_t k = 0; k < N; k++) {
+        const double inv_w = 1.0 / w[k], ak = a[k], pk = p[k];
+        double *jk = jac + 3 * k;
+        if (is_gauss[k]) {
+            #pragma omp simd
+            for (size_t m = 0; m < M; m++) {
+                const double u = (x[m] - pk) * inv_w;
+                /* the single exp is shared by the value and all three derivatives */
+                const double e = exp(-0.5 * u * u);
+                const double ae = ak * e;
+                out[m] += ae;
+                jk[m * stride + 0] = ae * u * u * inv_w;
+                jk[m * stride + 1] = e;
+                jk[m * stride + 2] = ae * u * inv_w;
+            }
+        }
+        else {
+            #pragma omp simd
+            for (size_t m = 0; m < M; m++) {
+                const double u = (x[m] - pk) * inv_w;
+                const double d = 1.0 / (1.0 + u * u);
+                const double ad = 2.0 * ak * d * d * inv_w;
+                out[m] += ak * d;
+                jk[m * stride + 0] = ad * u * u;
+                jk[m * stride + 1] = d;
+                jk[m * stride + 2] = ad * u;
+            }
+        }
+    }
+}
+
+/*
+ * Checks the sizes of the shared (x, widths, amplitudes, positions, is_gaussian,
+ * out) arguments. Returns 0 on success, or -1 with an exception set.
+ */
+static int
+check_sizes(Py_buffer *x, Py_buffer *w, Py_buffer *a, Py_buffer *p,
+            Py_buffer *g, Py_buffer *out, size_t *M, size_t *N)
+{
+    if (x->len % sizeof(double) || w->len % sizeof(double)) {
+        PyErr_SetString(PyExc_ValueError, "x and the peak parameters must be float64 arrays.");
+        return -1;
+    }
+    *M = x->len / sizeof(double);
+    *N = w->len / sizeof(double);
+    if (a->len != w->len || p->len != w->len || (size_t)g->len != *N) {
+        PyErr_SetString(PyExc_ValueError, "widths, amplitudes, positions and is_gaussian must have the same length.");
+        return -1;
+    }
+    if (out->len != x->len) {
+        PyErr_SetString(PyExc_ValueError, "out must have the same shape as x.");
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+py_peak_sum(PyObject *self, PyObject *args)
+{
+    Py_buffer x, w, a, p, g, out;
+    size_t M, N;
+
+    if (!PyArg_ParseTuple(args, "y*y*y*y*y*w*", &x, &w, &a, &p, &g, &out))
+        return NULL;
+
+    PyObject *result = NULL;
+    if (check_sizes(&x, &w, &a, &p, &g, &out, &M, &N) == 0) {
+        Py_BEGIN_ALLOW_THREADS
+        peak_sum(x.buf, M, w.buf, a.buf, p.buf, g.buf, N, out.buf);
+        Py_END_ALLOW_THREADS
+        Py_INCREF(Py_None);
+        result = Py_None;
+    }
+
+    PyBuffer_Release(&x);
+    PyBuffer_Release(&w);
+    PyBuffer_Release(&a);
+    PyBuffer_Release(&p);
+    PyBuffer_Release(&g);
+    PyBuffer_Release(&out);
+    return result;
+}
+
+static PyObject *
+py_peak_sum_and_jac(PyObject *self, PyObject *args)
+{
+    Py_buffer x, w, a, p, g, out, jac;
+    size_t M, N;
+
+    if (!PyArg_ParseTuple(args, "y*y*y*y*y*w*w*", &x, &w, &a, &p, &g, &out, &jac))
+        return NULL;
+
+    PyObject *result = NULL;
+    if (check_sizes(&x, &w, &a, &p, &g, &out, &M, &N) == 0) {
+        if ((size_t)jac.len != 3 * N * M * sizeof(double)) {
+            PyErr_SetString(PyExc_ValueError, "jac must have shape (len(x), 3*N).");
+        }
+        else {
+            Py_BEGIN_ALLOW_THREADS
+            peak_sum_and_jac(x.buf, M, w.buf, a.buf, p.buf, g.buf, N, out.buf, jac.buf);
+            Py_END_ALLOW_THREADS
+            Py_INCREF(Py_None);
+            result = Py_None;
+        }
+    }
+
+    PyBuffer_Release(&x);
+    PyBuffer_Release(&w);
+    PyBuffer_Release(&a);
+    PyBuffer_Release(&p);
+    PyBuffer_Release(&g);
+    PyBuffer_Release(&out);
+    PyBuffer_Release(&jac);
+    return result;
+}
+
+static PyMethodDef peakkernel_methods[] = {
+    {"peak_sum", py_peak_sum, METH_VARARGS,
+     "peak_sum(x, widths, amplitudes, positions, is_gaussian, out)\n\n"
+     "Writes the sum of the peaks at x into out."},
+    {"peak_sum_and_jac", py_peak_sum_and_jac, METH_VARARGS,
+     "peak_sum_and_jac(x, widths, amplitudes, positions, is_gaussian, out, jac)\n\n"
+     "Writes the sum of the peaks at x into out, and its Jacobian w.r.t. the\n"
+     "(width, amplitude, position) of each peak into jac, of shape (len(x), 3*N)."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef peakkernel_module = {
+    PyModuleDef_HEAD_INIT,
+    "_peakkernel",
+    "Fused C kernels for sums of peaks.",
+    -1,
+    peakkernel_methods
+};
+
+PyMODINIT_FUNC
+PyInit__peakkernel(void)
+{
+    return PyModule_Create(&peakkernel_module);
+}
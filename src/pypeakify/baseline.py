@@ -1,6 +1,23 @@
 import numpy as np
 from scipy.interpolate import CubicSpline
 
+from .peak import _use_numba
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _horner_nb(breaks, c, x, out):
+        n = breaks.shape[0]
+        for k in prange(x.shape[0]):
+            # extrapolate with the end polynomials outside of the breakpoints
+            i = min(max(np.searchsorted(breaks, x[k]) - 1, 0), n - 2)
+            dx = x[k] - breaks[i]
+            out[k] = ((c[0, i]*dx + c[1, i])*dx + c[2, i])*dx + c[3, i]
+
 class IdentityBaseline:
     '''
     No baseline correction, or the identity baseline
@@ -30,7 +47,7 @@ class CubicSplineBaseline:
             y (numpy.ndarray): y-values of the cubic spline.
             bc_type (str): Type of boundary condition to use. Default is 'not-a-knot'. See `scipy.interpolate.CubicSpline` for more information.
         '''
-        self.spline = CubicSpline(x, y)
+        self.spline = CubicSpline(x, y, bc_type=bc_type)
     
     def __call__(self, x):
         '''
@@ -39,6 +56,12 @@ class CubicSplineBaseline:
         Args:
             x (numpy.ndarray): x-values at which to evaluate the baseline.
         '''
+        # the kernel only handles scalar-valued splines that extrapolate with the end polynomials,
+        # so e.g. periodic splines (extrapolate='periodic') are left to scipy
+        if self.spline.extrapolate is True and self.spline.c.ndim == 2 and _use_numba(x):
+            out = np.empty_like(x)
+            _horner_nb(self.spline.x, self.spline.c, x, out)
+            return out
         return self.spline(x)
 
 class PiecewiseLinearBaseline:
@@ -55,8 +78,9 @@ class PiecewiseLinearBaseline:
             x (numpy.ndarray): x-values of the vertices of the piecewise linear function
             y (numpy.ndarray): y-values of the vertices of the piecewise linear function
         '''
-        self.x = x
-        self.y = y
+        # converted once here rather than by np.interp on every call
+        self.x = np.ascontiguousarray(x, dtype=float)
+        self.y = np.ascontiguousarray(y, dtype=float)
     
     def __call__(self, x):
         '''
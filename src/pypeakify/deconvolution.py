@@ -1,9 +1,10 @@
+import os
+import multiprocessing
+
 import numpy as np
-import copy
-from scipy.optimize import curve_fit
-from tabulate import tabulate
+from scipy.optimize import curve_fit, differential_evolution
 
-from .peak import gaussian, lorentzian, Peak
+from .peak import _sum_peaks, _peaks_jac
 from .baseline import IdentityBaseline
 
 class Deconvolution:
@@ -19,73 +20,158 @@ class Deconvolution:
             peaks (list): List of Peak objects to be fit to the spectrum.
             baseline (Baseline): Baseline for fitting peaks. Default is the identity baseline.
         '''
-        self.peaks = [copy.deepcopy(peak) for peak in peaks]
+        self.peaks = [peak.clone() for peak in peaks]
         self.baseline = baseline
         
         self.N = len(peaks)
     
-    def fit(self, x, y):
+    def fit(self, x, y, global_search=False, de_kwargs=None, dtype=None, verbose=False):
         '''
         Fits the peaks to the spectrum.
         
+        If `global_search` is True, the initial guess is first improved by a differential evolution search within the peak constraints, which must then all be finite.
+        This is useful when the initial peak parameters are far from the solution.
+        
+        The peaks and their Jacobian are evaluated in the precision given by `dtype`, which by default follows the spectrum, so float32 spectra are fit in float32.
+        scipy always runs the solver itself in float64, and the fit parameters and errors are returned in float64.
+        If the peak amplitudes span more than 5 decades, float64 is used regardless, as smaller peaks would be lost to float32 rounding.
+        
         Args:
             x (numpy.ndarray): x-values at which to evaluate the spectrum.
             y (numpy.ndarray): y-values of the spectrum.
+            global_search (bool): Whether or not to seed the fit with a global search.
+            de_kwargs (dict): Additional keyword arguments to be passed to `scipy.optimize.differential_evolution`, e.g. `workers` to evaluate in parallel.
+            dtype (numpy.dtype): Floating point precision in which to evaluate the peaks, of `numpy.float32` or `numpy.float64`. If None, inferred from `x` and `y`.
+            verbose (bool): Whether or not to print the fitted peaks.
+        
+        Returns this deconvolution, so that calls can be chained, e.g. `print(deconvolution.fit(x, y))`.
         '''
         base = self.baseline(x)
         
+        if dtype is None:
+            dtype = np.result_type(x, y)
+        # only float32 and float64 are supported by the kernels, so anything else is fit in float64
+        dtype = np.dtype(np.float32) if np.dtype(dtype) == np.float32 else np.dtype(np.float64)
+        
+        amplitudes = np.abs([peak.amplitude for peak in self.peaks])
+        if dtype == np.float32 and amplitudes.max() > 1e5 * amplitudes.min():
+            dtype = np.dtype(np.float64)
+        
         # rescale so numerically feasible
         scale_x = np.max(x) - np.min(x)
         
-        fit_params = np.zeros(3*self.N)
-        min_bounds = np.zeros_like(fit_params)
-        max_bounds = np.zeros_like(fit_params)
-        
-        for i, peak in enumerate(self.peaks):
-            fit_params[3*i:3*i+3] = [peak.width / scale_x, peak.amplitude, peak.position / scale_x]
-            
-            min_bounds[3*i:3*i+3] = [peak.constrain_width[0] / scale_x, peak.constrain_amplitude[0], peak.constrain_position[0] / scale_x]
-            max_bounds[3*i:3*i+3] = [peak.constrain_width[1] / scale_x, peak.constrain_amplitude[1], peak.constrain_position[1] / scale_x]
+        # parameters are packed as (width, amplitude, position) for each peak in turn
+        scale = np.array([scale_x, 1, scale_x])
+        fit_params = (np.array([[peak.width, peak.amplitude, peak.position] for peak in self.peaks], dtype=float) / scale).ravel()
+        min_bounds = (np.array([[peak.constrain_width[0], peak.constrain_amplitude[0], peak.constrain_position[0]] for peak in self.peaks], dtype=float) / scale).ravel()
+        max_bounds = (np.array([[peak.constrain_width[1], peak.constrain_amplitude[1], peak.constrain_position[1]] for peak in self.peaks], dtype=float) / scale).ravel()
+
+        # peak types are fixed during the fit, so build their mask once up front
+        types = np.array([peak.peak_type == 'gaussian' for peak in self.peaks], dtype=bool)
+
+        if global_search:
+            bounds = list(zip(min_bounds, max_bounds))
+            if not np.all(np.isfinite(bounds)):
+                raise ValueError("All peak constraints must be finite to use `global_search`.")
+            de_kwargs = {'polish': False, 'seed': 0, **(de_kwargs or {})}
+            fit_params = differential_evolution(_SquaredResidual(x / scale_x, y - base, types), bounds, **de_kwargs).x
+
+        # x in the evaluation precision, converted once here rather than on every call, which the closures below use in place of x0
+        x_fit = np.asarray(x / scale_x, dtype=dtype)
+        # output buffer reused across evaluations; curve_fit subtracts the data into a new array, so nothing holds on to it
+        y0 = np.empty(x.shape, dtype=dtype)
 
         def optim_func(x0, *params):
             '''
             Function to be minimized in the optimization process.
-            
+
+            Evaluates all peaks at once with `_sum_peaks` rather than constructing a `Peak` per call.
+
+            Args:
+                x0 (numpy.ndarray): x-values passed by `curve_fit`; unused in favour of `x_fit`, which holds the same values.
+                *params: Parameters to be optimized.
+            '''
+            P = np.asarray(params, dtype=dtype).reshape(self.N, 3)
+            return _sum_peaks(x_fit, P[:, 0], P[:, 1], P[:, 2], types, out=y0)
+
+        def jac(x0, *params):
+            '''
+            Analytic Jacobian of `optim_func` with respect to the parameters.
+
             Args:
-                x (numpy.ndarray): x-values at which to evaluate the function.
+                x0 (numpy.ndarray): x-values passed by `curve_fit`; unused in favour of `x_fit`, which holds the same values.
                 *params: Parameters to be optimized.
+
+            Returns an array of shape (len(x), 3*N), with columns ordered as the parameters.
             '''
-            y0 = np.zeros_like(x)
-            for i in range(0, len(params), 3):
-                peak = Peak(self.peaks[int(i // 3)].peak_type, *params[i:i+3])
-                y0 += peak(x0)
-            return y0
+            P = np.asarray(params, dtype=dtype).reshape(self.N, 3)
+            return _peaks_jac(x_fit, P[:, 0], P[:, 1], P[:, 2], types)
 
-        self.fit_params, self.pcov = curve_fit(optim_func, x / scale_x, y - base, p0=fit_params, bounds=(min_bounds, max_bounds), maxfev=100000)
+        # curve_fit casts the data to float64 regardless, so only the peak evaluations above run in float32
+        kwargs = {'x_scale': 'jac'} if dtype == np.float32 else {}
+        self.fit_params, self.pcov = curve_fit(optim_func, x / scale_x, (y - base).astype(dtype), p0=fit_params, bounds=(min_bounds, max_bounds), jac=jac, maxfev=100000, **kwargs)
+        # promote before taking the diagonal and square root, in case a float32 Jacobian left the covariance in float32
+        self.pcov = self.pcov.astype(np.float64)
         self.perr = np.sqrt(np.diag(self.pcov))
         
-        for i in range(self.N):
-            self.peaks[i].width, self.peaks[i].amplitude, self.peaks[i].position = self.fit_params[3*i:3*i+3]
-            
-            fp = self.fit_params[3*i:3*i+3]
-            
-            self.peaks[i].width *= scale_x
-            self.peaks[i].position *= scale_x
-            
-            perr = self.perr[3*i:3*i+3]
-            
-            self.peaks[i].set_perr(perr[0] * scale_x, perr[1], perr[2] * scale_x)
-        
-        print(self)
+        W, A, P = (self.fit_params.reshape(self.N, 3) * scale).T
+        W_err, A_err, P_err = (self.perr.reshape(self.N, 3) * scale).T
+        for i, peak in enumerate(self.peaks):
+            peak.width, peak.amplitude, peak.position = W[i], A[i], P[i]
+            peak.set_perr(W_err[i], A_err[i], P_err[i])
+        
+        if verbose:
+            print(self)
+        return self
+    
+    def fit_many(self, x, Y, n_jobs=-1, parallel=True, verbose=False):
+        '''
+        Fits the peaks to many spectra sharing the same x-values, distributing the fits across processes.
+        
+        Each spectrum is fit independently, starting from the current state of the peaks. This deconvolution is not modified.
+        The baseline must be picklable to be sent to the worker processes, and as these are spawned, scripts calling this in parallel should be guarded by `if __name__ == '__main__':`.
+        
+        Args:
+            x (numpy.ndarray): x-values at which to evaluate the spectra.
+            Y (numpy.ndarray): y-values of the spectra, of shape (K, len(x)).
+            n_jobs (int): Number of worker processes. If -1, uses all available CPUs.
+            parallel (bool): Whether or not to fit in parallel. If False, or if there are too few spectra, the fits are run serially in this process.
+            verbose (bool): Whether or not to print the fitted peaks of each spectrum.
+        
+        Returns a list of K fitted `Deconvolution` objects, one per spectrum.
+        '''
+        Y = np.asarray(Y)
+        K = Y.shape[0]
+        n_workers = (os.cpu_count() or 1) if n_jobs < 0 else n_jobs
+        n_workers = min(n_workers, K)
+        
+        if parallel and n_workers > 1:
+            # batch several spectra per task to amortize the inter-process communication
+            chunksize = max(1, K // (4*n_workers))
+            # spawn rather than fork, as forking after the Numba kernels have started their threads can deadlock
+            # the state shared by all spectra is sent once per worker, so only the rows of Y are sent per task
+            initargs = (self.peaks, self.baseline, x, verbose)
+            with multiprocessing.get_context('spawn').Pool(n_workers, initializer=_init_worker, initargs=initargs) as pool:
+                results = pool.map(_fit_one, Y, chunksize=chunksize)
+        else:
+            results = [_fit_spectrum(self.peaks, self.baseline, x, y, verbose) for y in Y]
+        
+        deconvolutions = []
+        for peaks, fit_params, pcov in results:
+            deconvolution = Deconvolution(peaks, baseline=self.baseline)
+            deconvolution.fit_params, deconvolution.pcov = fit_params, pcov
+            deconvolution.perr = np.sqrt(np.diag(pcov))
+            deconvolutions.append(deconvolution)
+        return deconvolutions
     
     def __str__(self):
         '''
         Returns a string representation of the deconvolution.
         '''
-        return tabulate(
-            [[peak.peak_type, peak.width, peak.amplitude, peak.position] for peak in self.peaks],
-            headers=['Peak Type', 'Width', 'Amplitude', 'Position']
-        )
+        lines = [f"{'Peak Type':<12}{'Width':>14}{'Amplitude':>14}{'Position':>14}", '-' * 54]
+        for peak in self.peaks:
+            lines.append(f"{peak.peak_type:<12}{peak.width:>14.6g}{peak.amplitude:>14.6g}{peak.position:>14.6g}")
+        return '\n'.join(lines)
 
     def __call__(self, x):
         '''
@@ -94,10 +180,21 @@ class Deconvolution:
         Args:
             x (numpy.ndarray): x-values at which to evaluate the deconvolution.
         '''
-        y = np.zeros_like(x)
-        for i in range(0, self.N*3, 3):
-            y += self.peaks[int(i // 3)](x)
-        return y
+        # the peaks are summed over a flat array, so scalars and n-d inputs are flattened and reshaped back
+        shape = np.shape(x)
+        return _sum_peaks(np.ravel(x), *self._peak_arrays()).reshape(shape)
+
+    def _peak_arrays(self):
+        '''
+        Returns the current widths, amplitudes, positions and a boolean mask of Gaussian peaks as length-N arrays.
+
+        These are read from `self.peaks` on every call so that any changes made to the peaks after fitting are respected.
+        '''
+        w = np.array([peak.width for peak in self.peaks], dtype=float)
+        a = np.array([peak.amplitude for peak in self.peaks], dtype=float)
+        p = np.array([peak.position for peak in self.peaks], dtype=float)
+        gmask = np.array([peak.peak_type == 'gaussian' for peak in self.peaks], dtype=bool)
+        return w, a, p, gmask
 
     def plot(self, ax, x, y=None, show_base=True, show_peaks=True, show_error=False, **kwargs):
         '''
@@ -112,15 +209,82 @@ class Deconvolution:
             show_error (bool): Whether or not to plot the error bars.
             **kwargs: Additional matplotlib keyword arguments to be passed to the plot.
         '''
+        # evaluated once here and shared by every peak and the total
+        base = self.baseline(x) if show_base else None
         if show_peaks:
             for peak in self.peaks:
-                peak.plot(ax, x, baseline=self.baseline if show_base else None, show_error=show_error, color='r', ls='--', **kwargs)
+                peak.plot(ax, x, baseline=base, show_error=show_error, color='r', ls='--', **kwargs)
                 
         y_pred = self(x)
         if show_base:
-            y_pred += self.baseline(x)
+            y_pred += base
         ax.plot(x, y_pred, c='b', ls='--', label='Deconvolution', **kwargs)
         
         if y is not None:
             ax.plot(x, y, label='Ground Truth', c='k')
-        
\ No newline at end of file
+
+class _SquaredResidual:
+    '''
+    Sum of squared residuals of a set of peaks against a spectrum, as minimized by the global search in `Deconvolution.fit`.
+    
+    A module-level class rather than a closure so that it can be sent to worker processes.
+    '''
+    def __init__(self, x, y, is_gaussian):
+        self.x = x
+        self.y = y
+        self.is_gaussian = is_gaussian
+    
+    def __call__(self, params):
+        P = params.reshape(-1, 3)
+        r = _sum_peaks(self.x, P[:, 0], P[:, 1], P[:, 2], self.is_gaussian) - self.y
+        return np.dot(r, r)
+
+# (peaks, baseline, x, verbose) shared by all spectra fit by a `Deconvolution.fit_many` worker process
+_worker_state = None
+
+def _init_worker(peaks, baseline, x, verbose):
+    '''
+    Initializes a `Deconvolution.fit_many` worker process with the state shared by all spectra.
+    
+    Each worker fits whole spectra, so the Numba kernels are kept single-threaded to avoid oversubscribing the CPUs.
+    
+    Args:
+        peaks (list): Initial peaks.
+        baseline (Baseline): Baseline for fitting peaks.
+        x (numpy.ndarray): x-values of the spectra.
+        verbose (bool): Whether or not to print the fitted peaks of each spectrum.
+    '''
+    global _worker_state
+    _worker_state = (peaks, baseline, x, verbose)
+    try:
+        import numba
+    except ImportError:
+        return
+    numba.set_num_threads(1)
+
+def _fit_one(y):
+    '''
+    Fits a single spectrum in a `Deconvolution.fit_many` worker process, using the state set by `_init_worker`.
+    
+    Args:
+        y (numpy.ndarray): y-values of the spectrum.
+    '''
+    peaks, baseline, x, verbose = _worker_state
+    return _fit_spectrum(peaks, baseline, x, y, verbose)
+
+def _fit_spectrum(peaks, baseline, x, y, verbose):
+    '''
+    Fits a single spectrum for `Deconvolution.fit_many`.
+    
+    Args:
+        peaks (list): Initial peaks.
+        baseline (Baseline): Baseline for fitting peaks.
+        x (numpy.ndarray): x-values of the spectrum.
+        y (numpy.ndarray): y-values of the spectrum.
+        verbose (bool): Whether or not to print the fitted peaks.
+    
+    Returns a tuple of the fitted peaks, fit parameters and covariance matrix.
+    '''
+    deconvolution = Deconvolution(peaks, baseline=baseline)
+    deconvolution.fit(x, y, verbose=verbose)
+    return deconvolution.peaks, deconvolution.fit_params, deconvolution.pcov
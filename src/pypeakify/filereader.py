@@ -1,8 +1,54 @@
 import csv
+import io
 import requests
 import numpy as np
 import jcamp
 
+def _read_ascii(f, delim=None):
+    '''
+    Parse two column ascii data from an open, seekable file-like object.
+    
+    Args:
+        f (file): File-like object to read from.
+        delim (str): Delimiter used in file. If None, will attempt to guess from the start of the file.
+    '''
+    if delim is None:
+        sample = f.read(8192)
+        # only sniff complete lines
+        if len(sample) == 8192 and '\n' in sample:
+            sample = sample[:sample.rindex('\n')]
+        delim = csv.Sniffer().sniff(sample).delimiter
+        f.seek(0)
+    
+    # loadtxt treats None as any run of whitespace
+    if delim.isspace():
+        delim = None
+    
+    try:
+        return np.loadtxt(f, delimiter=delim, unpack=True)
+    except ValueError:
+        # fall back to the more lenient parser, which reads e.g. header lines and missing values as nan
+        f.seek(0)
+        return np.transpose(np.genfromtxt(f, delimiter=delim))
+
+def _sort_by_x(x, y):
+    '''
+    Sort x, y data w.r.t. x, skipping the sort when x is already monotonic, as is typical for spectra.
+    
+    Args:
+        x (np.array): x data.
+        y (np.array): y data.
+    '''
+    d = np.diff(x)
+    if (d >= 0).all():
+        pass
+    elif (d <= 0).all():
+        x, y = x[::-1], y[::-1]
+    else:
+        x_ind = np.argsort(x, kind='stable')
+        x, y = x[x_ind], y[x_ind]
+    return np.ascontiguousarray(x), np.ascontiguousarray(y)
+
 def import_ascii_file(fname, delim=None):
     '''
     Import x (abscissa), y (ordinate) spectrum data from file. Assumes two column ascii format where the first column is x and the second column is y.
@@ -21,22 +67,13 @@ def import_ascii_file(fname, delim=None):
         return None, None
     else:
         with f:
-            fc = f.read()
-            if delim is None:
-                sniffer = csv.Sniffer()
-                delimiter = sniffer.sniff(fc).delimiter
-                x, y = np.transpose(np.genfromtxt(fc.splitlines(), delimiter=delimiter))
-            else:
-                x, y = np.transpose(np.genfromtxt(fc.splitlines(), delimiter=delim))
+            x, y = _read_ascii(f, delim)
             
             if x is None or y is None:
                 print(f'Error: Unable to parse data from {fname}')
                 return None, None
 
-            # sort y w.r.t. x
-            x_ind = np.argsort(x)
-            x, y = x[x_ind], y[x_ind]
-            return x, y
+            return _sort_by_x(x, y)
 
 def import_jcamp_file(fname):
     '''
@@ -61,21 +98,13 @@ def import_ascii_url(url, delim=None):
     '''
     try:
         response = requests.get(url)
-        if delim is None:
-            sniffer = csv.Sniffer()
-            delimiter = sniffer.sniff(response.text).delimiter
-            x, y = np.transpose(np.genfromtxt(response.text.splitlines(), delimiter=delimiter))
-        else:
-            x, y = np.transpose(np.genfromtxt(response.text.splitlines(), delimiter=delim))
+        x, y = _read_ascii(io.StringIO(response.text), delim)
 
         if x is None or y is None:
             print(f'Error: Unable to parse data from {url}')
             return None, None
 
-        # sort y w.r.t. x
-        x_ind = np.argsort(x)
-        x, y = x[x_ind], y[x_ind]
-        return x, y
+        return _sort_by_x(x, y)
     except IOError:
         print(f'Unable to open file at {url}')
         return None, None
@@ -104,13 +133,36 @@ def import_jcamp_url(url):
         print(f'Error: {e}')
         return None
 
+def _nearest_idx(x, x0):
+    '''
+    Find the index of the nearest x value to each x0 by binary search. x must be sorted, in either ascending or descending order.
+    
+    Args:
+        x (np.array): Sorted x data.
+        x0 (float or np.array): x value(s) to find the nearest index for.
+    '''
+    descending = x[0] > x[-1]
+    if descending:
+        x = x[::-1]
+    i = np.searchsorted(x, x0)
+    i = np.clip(i, 1, len(x) - 1)
+    left = x[i - 1]
+    right = x[i]
+    # as with argmin, ties go to the lower index of the original x, so pick the nearest value
+    # and return the first index at which it occurs, in case x has repeated values
+    if descending:
+        nearest = np.where(x0 - left < right - x0, left, right)
+        return len(x) - np.searchsorted(x, nearest, side='right')
+    nearest = np.where(x0 - left <= right - x0, left, right)
+    return np.searchsorted(x, nearest)
+
 def normalize_data(x, y, range=None):
     '''
     Normalize y data to range [0, 1].
     
     If range is not None, normalize y data to range [0, 1] within the specified x range.
     
-    x and y must have the same shape.
+    x and y must have the same shape, and x must be sorted in ascending (as returned by `import_ascii_file`) or descending order.
     
     Args:
         x (np.array): x data.
@@ -119,27 +171,23 @@ def normalize_data(x, y, range=None):
     '''
     if range is None:
         return x, (y - np.min(y)) / (np.max(y) - np.min(y))
-    diffs1 = np.abs(x - range[0])
-    diffs2 = np.abs(x - range[1])
-    i1 = np.argmin(diffs1)
-    i2 = np.argmin(diffs2)
+    i1 = int(_nearest_idx(x, range[0]))
+    i2 = int(_nearest_idx(x, range[1]))
     return x, (y - np.min(y[i1:i2])) / (np.max(y[i1:i2]) - np.min(y[i1:i2]))
 
 def crop(x, y, range):
     '''
     Crop x, y data to specified x range. `range` must be a pair of values in the domain of x.
     
-    x and y must have the same shape.
+    x and y must have the same shape, and x must be sorted in ascending (as returned by `import_ascii_file`) or descending order.
     
     Args:
         x (np.array): x data.
         y (np.array): y data.
         range (tuple): x range to crop x, y data to, in the form (x_min, x_max).
     '''
-    diffs1 = np.abs(x - range[0])
-    diffs2 = np.abs(x - range[1])
-    i1 = np.argmin(diffs1)
-    i2 = np.argmin(diffs2)
+    i1 = int(_nearest_idx(x, range[0]))
+    i2 = int(_nearest_idx(x, range[1]))
     x = x[i1:i2]
     y = y[i1:i2]
     return x, y
@@ -150,12 +198,14 @@ def nearest(x, y, x0):
     
     Useful e.g. for identifying nodes for baseline correction that exist on the spectrum.
     
+    x must be sorted in ascending (as returned by `import_ascii_file`) or descending order.
+    
     Args:
         x (np.array): x data.
         y (np.array): y data.
         x0 (float): x value to find nearest y value for.
     '''
-    idx = (np.abs(x-x0)).argmin()
+    idx = int(_nearest_idx(x, x0))
     return y[idx]
 
 def nearest_points(x, y, x0):
@@ -164,10 +214,12 @@ def nearest_points(x, y, x0):
     
     Useful e.g. for identifying nodes for baseline correction that exist on the spectrum.
     
+    x must be sorted in ascending (as returned by `import_ascii_file`) or descending order.
+    
     Args:
         x (np.array): x data.
         y (np.array): y data.
         x0 (np.array): x values to find nearest y values for.
     '''
-    return np.array([nearest(x, y, x0i) for x0i in x0])
+    return y[_nearest_idx(x, np.asarray(x0))]
 
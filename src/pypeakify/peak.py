@@ -1,5 +1,57 @@
+import math
 import numpy as np
 
+try:
+    from . import _peakkernel
+except ImportError:
+    _peakkernel = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # there is no single Gaussian kernel, as NumPy's vectorized exp is faster than a loop over the scalar math.exp
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _lorentzian_nb(x, width, amplitude, position, out):
+        for i in prange(x.shape[0]):
+            u = (x[i] - position) / width
+            out[i] = amplitude / (1 + u * u)
+
+    @njit(cache=True, fastmath=True, parallel=True)
+    def _sum_peaks_nb(x, widths, amplitudes, positions, is_gaussian, out):
+        for i in prange(x.shape[0]):
+            s = 0.0
+            for k in range(widths.shape[0]):
+                u = (x[i] - positions[k]) / widths[k]
+                if is_gaussian[k]:
+                    s += amplitudes[k] * math.exp(-0.5 * u * u)
+                else:
+                    s += amplitudes[k] / (1 + u * u)
+            out[i] = s
+
+def _use_numba(x):
+    '''
+    Whether the compiled kernels can be used for the given x-values. They only handle 1D float32 and float64 arrays.
+    '''
+    return njit is not None and isinstance(x, np.ndarray) and x.ndim == 1 and x.dtype in (np.float32, np.float64)
+
+def _use_kernel(x, out=None):
+    '''
+    Whether the C extension kernels can be used for the given x-values and output array. They only handle contiguous 1D float64 arrays.
+    '''
+    def usable(arr):
+        return isinstance(arr, np.ndarray) and arr.ndim == 1 and arr.dtype == np.float64 and arr.flags.c_contiguous
+    return _peakkernel is not None and usable(x) and (out is None or usable(out))
+
+def _kernel_args(widths, amplitudes, positions, is_gaussian):
+    '''
+    Converts the peak parameters to the contiguous arrays expected by the C extension kernels.
+    '''
+    return (np.ascontiguousarray(widths, dtype=np.float64), np.ascontiguousarray(amplitudes, dtype=np.float64),
+            np.ascontiguousarray(positions, dtype=np.float64), np.ascontiguousarray(is_gaussian, dtype=bool))
+
 def gaussian(x, width, amplitude, position):
     '''
     Calculates the value of a Gaussian peak at the given x-values.
@@ -22,8 +74,127 @@ def lorentzian(x, width, amplitude, position):
         amplitude (float): Amplitude of the peak.
         position (float): Position of the peak.
     '''
+    if _use_numba(x):
+        out = np.empty_like(x)
+        _lorentzian_nb(x, width, amplitude, position, out)
+        return out
     return amplitude / (1 + ((x - position) / width)**2)
 
+def _gaussian_into(x, width, amplitude, position, out, tmp):
+    '''
+    Calculates the value of a Gaussian peak at the given x-values into `out`, using `tmp` as scratch space instead of allocating temporaries.
+    
+    Args:
+        x (numpy.ndarray): x-values at which to evaluate the peak.
+        width (float): Width of the peak.
+        amplitude (float): Amplitude of the peak.
+        position (float): Position of the peak.
+        out (numpy.ndarray): Array of the same shape as `x` to write the peak into.
+        tmp (numpy.ndarray): Scratch array of the same shape as `x`.
+    '''
+    np.subtract(x, position, out=tmp)
+    np.divide(tmp, width, out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    np.multiply(tmp, -0.5, out=tmp)
+    np.exp(tmp, out=out)
+    np.multiply(out, amplitude, out=out)
+    return out
+
+def _lorentzian_into(x, width, amplitude, position, out, tmp):
+    '''
+    Calculates the value of a Lorentzian peak at the given x-values into `out`, using `tmp` as scratch space instead of allocating temporaries.
+    
+    Args:
+        x (numpy.ndarray): x-values at which to evaluate the peak.
+        width (float): Width of the peak.
+        amplitude (float): Amplitude of the peak.
+        position (float): Position of the peak.
+        out (numpy.ndarray): Array of the same shape as `x` to write the peak into.
+        tmp (numpy.ndarray): Scratch array of the same shape as `x`. Not needed, and may be None, when the Numba kernels are used.
+    '''
+    if _use_numba(x):
+        _lorentzian_nb(x, width, amplitude, position, out)
+        return out
+    np.subtract(x, position, out=tmp)
+    np.divide(tmp, width, out=tmp)
+    np.multiply(tmp, tmp, out=tmp)
+    np.add(tmp, 1, out=tmp)
+    np.divide(amplitude, tmp, out=out)
+    return out
+
+def _sum_peaks(x, widths, amplitudes, positions, is_gaussian, out=None):
+    '''
+    Calculates the sum of several peaks at the given x-values.
+
+    Args:
+        x (numpy.ndarray): x-values at which to evaluate the peaks.
+        widths (numpy.ndarray): Widths of the peaks.
+        amplitudes (numpy.ndarray): Amplitudes of the peaks.
+        positions (numpy.ndarray): Positions of the peaks.
+        is_gaussian (numpy.ndarray): Boolean mask, True for Gaussian peaks and False for Lorentzian peaks.
+        out (numpy.ndarray): Array of the same shape as `x` to write the sum into. If None, a new array is allocated.
+    '''
+    if _use_kernel(x, out):
+        if out is None:
+            out = np.empty_like(x)
+        _peakkernel.peak_sum(x, *_kernel_args(widths, amplitudes, positions, is_gaussian), out)
+        return out
+    
+    if _use_numba(x):
+        if out is None:
+            out = np.empty_like(x)
+        _sum_peaks_nb(x, widths, amplitudes, positions, is_gaussian, out)
+        return out
+
+    u = (x[None, :] - positions[:, None]) / widths[:, None]
+    vals = np.empty_like(u)
+    vals[is_gaussian] = amplitudes[is_gaussian, None] * np.exp(-0.5 * u[is_gaussian]**2)
+    vals[~is_gaussian] = amplitudes[~is_gaussian, None] / (1 + u[~is_gaussian]**2)
+    return vals.sum(axis=0, out=out)
+
+def _peaks_jac(x, widths, amplitudes, positions, is_gaussian):
+    '''
+    Calculates the Jacobian of the sum of several peaks with respect to their (width, amplitude, position) parameters.
+    
+    Args:
+        x (numpy.ndarray): x-values at which to evaluate the Jacobian.
+        widths (numpy.ndarray): Widths of the peaks.
+        amplitudes (numpy.ndarray): Amplitudes of the peaks.
+        positions (numpy.ndarray): Positions of the peaks.
+        is_gaussian (numpy.ndarray): Boolean mask, True for Gaussian peaks and False for Lorentzian peaks.
+    
+    Returns an array of shape (len(x), 3*N), with the columns of each peak in turn.
+    '''
+    N = len(widths)
+    
+    if _use_kernel(x):
+        J = np.empty((x.size, 3*N))
+        # the kernel shares each exp between the sum and the derivatives, the sum itself is not needed here
+        _peakkernel.peak_sum_and_jac(x, *_kernel_args(widths, amplitudes, positions, is_gaussian), np.empty_like(x), J)
+        return J
+    
+    gidx = np.flatnonzero(is_gaussian)
+    lidx = np.flatnonzero(~is_gaussian)
+    w, a, p = widths, amplitudes, positions
+    u = (x[None, :] - p[:, None]) / w[:, None]
+
+    J = np.empty((N, 3, x.size), dtype=u.dtype)
+
+    # d/da of the gaussian is the unit-amplitude gaussian itself
+    e = np.exp(-0.5 * u[gidx]**2)
+    ae = a[gidx, None] * e / w[gidx, None]
+    J[gidx, 0] = ae * u[gidx]**2
+    J[gidx, 1] = e
+    J[gidx, 2] = ae * u[gidx]
+
+    d = 1 / (1 + u[lidx]**2)
+    ad = 2 * a[lidx, None] * d**2 / w[lidx, None]
+    J[lidx, 0] = ad * u[lidx]**2
+    J[lidx, 1] = d
+    J[lidx, 2] = ad * u[lidx]
+
+    return J.reshape(3*N, x.size).T
+
 class Peak:
     '''
     A class representing a peak in a spectrum.
@@ -56,6 +227,27 @@ class Peak:
         self.constrain_amplitude = constrain_amplitude
         self.constrain_position = constrain_position
     
+    @property
+    def peak_type(self):
+        '''
+        Type of the peak. Of 'gaussian' or 'lorentzian'.
+        '''
+        return self._peak_type
+    
+    @peak_type.setter
+    def peak_type(self, peak_type):
+        # bind the peak functions here, so they are not dispatched on the type at every evaluation
+        if peak_type == 'gaussian':
+            self._fn, self._fn_into = gaussian, _gaussian_into
+            # 2 sqrt(2 ln(2)) ~= 2.35482005
+            self._fwhm_factor = 2.35482005
+        elif peak_type == 'lorentzian':
+            self._fn, self._fn_into = lorentzian, _lorentzian_into
+            self._fwhm_factor = 2
+        else:
+            raise ValueError("`peak_type` must be 'gaussian' or 'lorentzian'.")
+        self._peak_type = peak_type
+    
     def __call__(self, x):
         '''
         Calculates the value of the peak at the given x-values.
@@ -63,12 +255,16 @@ class Peak:
         Args:
             x (numpy.ndarray): x-values at which to evaluate the peak.
         '''
-        if self.peak_type == 'gaussian':
-            return gaussian(x, self.width, self.amplitude, self.position)
-        elif self.peak_type == 'lorentzian':
-            return lorentzian(x, self.width, self.amplitude, self.position)
-        else:
-            raise ValueError("`peak_type` must be 'gaussian' or 'lorentzian'.")
+        return self._fn(x, self.width, self.amplitude, self.position)
+    
+    def clone(self):
+        '''
+        Returns a copy of the peak, including the fit errors if they have been set.
+        '''
+        peak = Peak(self.peak_type, self.width, self.amplitude, self.position, self.constrain_width, self.constrain_amplitude, self.constrain_position)
+        if hasattr(self, 'width_perr'):
+            peak.set_perr(self.width_perr, self.amplitude_perr, self.position_perr)
+        return peak
     
     def set_perr(self, width_perr, amplitude_perr, position_perr):
         self.width_perr = width_perr
@@ -84,16 +280,14 @@ class Peak:
         Args:
             x (numpy.ndarray): x-values at which to evaluate the peak.
         '''
-        if self.peak_type == 'gaussian':
-            ub = gaussian(x, self.width + self.width_perr, self.amplitude + self.amplitude_perr, self.position + self.position_perr)
-            lb = gaussian(x, self.width - self.width_perr, self.amplitude - self.amplitude_perr, self.position - self.position_perr)
-            return ub, lb
-        elif self.peak_type == 'lorentzian':
-            ub = lorentzian(x, self.width + self.width_perr, self.amplitude + self.amplitude_perr, self.position + self.position_perr)
-            lb = lorentzian(x, self.width - self.width_perr, self.amplitude - self.amplitude_perr, self.position - self.position_perr)
-            return ub, lb
-        else:
-            raise ValueError("`peak_type` must be 'gaussian' or 'lorentzian'.")
+        x = np.asarray(x)
+        ub = np.empty(x.shape, dtype=np.result_type(x, 1.0))
+        lb = np.empty_like(ub)
+        tmp = np.empty_like(ub)
+        
+        self._fn_into(x, self.width + self.width_perr, self.amplitude + self.amplitude_perr, self.position + self.position_perr, ub, tmp)
+        self._fn_into(x, self.width - self.width_perr, self.amplitude - self.amplitude_perr, self.position - self.position_perr, lb, tmp)
+        return ub, lb
 
     def plot(self, ax, x=None, baseline=None, show_error=False, **kwargs):
         '''
@@ -102,7 +296,7 @@ class Peak:
         Args:
             ax (matplotlib.axes.Axes): Axis on which to plot the peak.
             x (numpy.ndarray): x-values at which to evaluate the peak. If None, x-values are generated near the position.
-            baseline (Baseline): Baseline object to be plotted along with the peak. If None, no baseline is plotted.
+            baseline (Baseline or numpy.ndarray): Baseline object to be plotted along with the peak, or its values already evaluated at `x`. If None, no baseline is plotted.
             show_error (bool): Whether or not to plot error bars on the peak.
             **kwargs: Additional matplotlib keyword arguments to be passed to the plot function.
         '''
@@ -110,26 +304,23 @@ class Peak:
             fwhm = self.get_fwhm()
             x = np.linspace(self.position - 4*fwhm, self.position + 4*fwhm, 1000)
         
+        if callable(baseline):
+            baseline = baseline(x)
+        
         if show_error:
             ub, lb = self.get_fit_error(x)
             if baseline is not None:
-                ub += baseline(x)
-                lb += baseline(x)
+                ub += baseline
+                lb += baseline
             ax.fill_between(x, lb, ub, alpha=0.5, **kwargs)
         
         y = self(x)
         if baseline is not None:
-            y += baseline(x)
+            y += baseline
         ax.plot(x, y, **kwargs)
         
     def get_fwhm(self):
         '''
         Gets the full width at half maximum of the peak.
         '''
-        if self.peak_type == 'gaussian':
-            # 2 sqrt(2 ln(2)) ~= 2.35482005
-            return 2.35482005 * self.width
-        elif self.peak_type == 'lorentzian':
-            return 2 * self.width
-        else:
-            raise ValueError("peak_type must be 'gaussian' or 'lorentzian'.")
+        return self._fwhm_factor * self.width